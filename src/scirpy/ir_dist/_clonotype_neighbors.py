@@ -1,19 +1,53 @@
 import itertools
-from collections.abc import Mapping, Sequence
-from multiprocessing import cpu_count
+from collections.abc import Callable, Iterator, Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from multiprocessing import cpu_count, get_context
 from typing import Literal, Optional, Union
 
 import numpy as np
 import pandas as pd
 import scipy.sparse as sp
 from scanpy import logging
-from tqdm.contrib.concurrent import process_map
 
 from scirpy.get import _has_ir
 from scirpy.get import airr as get_airr
 from scirpy.util import DataHandler, tqdm
 
-from ._util import DoubleLookupNeighborFinder, merge_coo_matrices, reduce_and, reduce_or
+from ._util import (
+    NAN_DIST,
+    DoubleLookupNeighborFinder,
+    _from_shared_memory,
+    _release_shared_memory,
+    _to_shared_memory,
+    reduce_and,
+    reduce_chains_all,
+    reduce_or_into,
+)
+
+#: Combinations of (query chain, reference chain) that need to be looked up for each `dual_ir` option
+_CHAIN_IDS = {
+    "primary_only": ((1, 1),),
+    "all": ((1, 1), (2, 2), (1, 2), (2, 1)),
+    "any": ((1, 1), (2, 2), (1, 2), (2, 1)),
+}
+
+#: The `ClonotypeNeighbors` instance of a worker process, see `_init_worker`
+_worker_ctn: Optional["ClonotypeNeighbors"] = None
+
+
+def _init_worker(ctn: "ClonotypeNeighbors") -> None:
+    """Initialize a worker process of `ClonotypeNeighbors.compute_distances`.
+
+    The instance is sent to each worker only once, instead of once per task
+    """
+    global _worker_ctn
+    _worker_ctn = ctn
+
+
+def _dist_for_clonotype_range_worker(start: int, stop: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Call `_dist_for_clonotype_range` on the instance of the worker process."""
+    return _worker_ctn._dist_for_clonotype_range(start, stop)  # type: ignore
 
 
 class ClonotypeNeighbors:
@@ -45,23 +79,109 @@ class ClonotypeNeighbors:
 
         self._receptor_arm_cols = ["VJ", "VDJ"] if self.receptor_arms in ["all", "any"] else [self.receptor_arms]
         self._dual_ir_cols = ["1"] if self.dual_ir == "primary_only" else ["1", "2"]
+        self._chain_ids = _CHAIN_IDS[self.dual_ir]
+        self._merge_chains = {
+            "primary_only": self._merge_chains_primary_only,
+            "all": self._merge_chains_all,
+            "any": self._merge_chains_any,
+        }[self.dual_ir]
+        self._merge_arms = {
+            "all": self._merge_arms_all,
+            "any": self._merge_arms_any,
+        }.get(self.receptor_arms, self._merge_arms_single)
 
         # Initialize the DoubleLookupNeighborFinder and all lookup tables
         start = logging.info("Initializing lookup tables. ")  # type: ignore
 
+        # The "nan" masks of the sequence columns and the chain counts are computed
+        # once here, such that `_dist_for_clonotype` doesn't need to touch the data frames.
         self.cell_indices, self.clonotypes = self._make_clonotype_table(params)
-        self._chain_count = self._make_chain_count(self.clonotypes)
+        self._nan_mask = self._make_nan_mask(self.clonotypes)
+        self._chain_count = self._make_chain_count(self._nan_mask)
         if params2 is not None:
             self.cell_indices2, self.clonotypes2 = self._make_clonotype_table(params2)
-            self._chain_count2 = self._make_chain_count(self.clonotypes2)
+            self._nan_mask2 = self._make_nan_mask(self.clonotypes2)
+            self._chain_count2 = self._make_chain_count(self._nan_mask2)
         else:
-            self.cell_indices2, self.clonotypes2, self._chain_count2 = None, None, None
+            self.cell_indices2, self.clonotypes2 = None, None
+            self._nan_mask2, self._chain_count2 = self._nan_mask, self._chain_count
+
+        # whether the instance is currently sent to worker processes, see `_dispatch_to_workers`
+        self._dispatching = False
+        # specification of the arrays in shared memory, see `_shared_memory`
+        self._shared_arrays: Optional[dict[str, dict]] = None
+        self._shared_memory_handles: list = []
 
         self.neighbor_finder = DoubleLookupNeighborFinder(self.clonotypes, self.clonotypes2)
         self._add_distance_matrices()
         self._add_lookup_tables()
         logging.hint("Done initializing lookup tables.", time=start)  # type: ignore
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shared_memory_handles"] = []
+        if self._dispatching:
+            # These attributes are not required for computing distances. Excluding them
+            # reduces the amount of data sent to worker processes.
+            for key in ["distance_dict", "cell_indices", "cell_indices2"]:
+                state[key] = None
+            # Of the clonotype tables, only the number of clonotypes is required.
+            for key in ["clonotypes", "clonotypes2"]:
+                if state[key] is not None:
+                    state[key] = state[key].iloc[:, :0]
+        if self._shared_arrays is not None:
+            # the arrays are restored from shared memory in `__setstate__`
+            for key in ["_nan_mask", "_chain_count", "_nan_mask2", "_chain_count2"]:
+                state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_arrays is not None:
+            for key, specs in self._shared_arrays.items():
+                setattr(
+                    self, key, {k: _from_shared_memory(spec, self._shared_memory_handles) for k, spec in specs.items()}
+                )
+            # without a second clonotype table, the masks of the first one are used
+            if "_nan_mask2" not in self._shared_arrays:
+                self._nan_mask2, self._chain_count2 = self._nan_mask, self._chain_count
+            self._shared_arrays = None
+        self._dispatching = False
+
+    @contextmanager
+    def _dispatch_to_workers(self) -> Iterator["ClonotypeNeighbors"]:
+        """Context manager that reduces the pickled state to the attributes required for
+        `_dist_for_clonotype_range` while the instance is sent to worker processes.
+
+        Outside of the context, pickling and copying the instance is lossless.
+        """
+        self._dispatching = True
+        try:
+            yield self
+        finally:
+            self._dispatching = False
+
+    @contextmanager
+    def _shared_memory(self) -> Iterator["ClonotypeNeighbors"]:
+        """Context manager that places all arrays required for `_dist_for_clonotype_range` in
+        shared memory, such that they don't need to be copied when the instance is pickled.
+
+        See also :meth:`DoubleLookupNeighborFinder.shared_memory`.
+        """
+        handles: list = []
+        keys = ["_nan_mask", "_chain_count"]
+        if self.clonotypes2 is not None:
+            keys += ["_nan_mask2", "_chain_count2"]
+        try:
+            self._shared_arrays = {
+                key: {k: _to_shared_memory(v, handles) for k, v in getattr(self, key).items()} for key in keys
+            }
+            with self.neighbor_finder.shared_memory():
+                yield self
+        finally:
+            self._shared_arrays = None
+            _release_shared_memory(handles)
+
     def _make_clonotype_table(self, params: DataHandler) -> tuple[Mapping, pd.DataFrame]:
         """Define 'preliminary' clonotypes based identical IR features."""
         if not params.adata.obs_names.is_unique:
@@ -73,8 +193,10 @@ class ClonotypeNeighbors:
         chains = [f"{arm}_{chain}" for arm, chain in itertools.product(self._receptor_arm_cols, self._dual_ir_cols)]
 
         obs = get_airr(params, airr_variables, chains)
-        # remove entries without receptor (e.g. only non-productive chains) or no sequences
-        obs = obs.loc[_has_ir(params) & np.any(~pd.isnull(obs), axis=1), :]
+        # remove entries without receptor (e.g. only non-productive chains) or no sequences.
+        # The mask is computed once on the underlying array and rows are selected by position.
+        keep = _has_ir(params) & ~np.all(pd.isnull(obs.values), axis=1)
+        obs = obs.iloc[np.flatnonzero(keep), :]
         if self.match_columns is not None:
             obs = obs.join(
                 params.get_obs(self.match_columns),
@@ -84,38 +206,39 @@ class ClonotypeNeighbors:
 
         # Converting nans to str("nan"), as we want string dtype
         for col in obs.columns:
-            if obs[col].dtype == "category":
-                obs[col] = obs[col].astype(str)
-            obs.loc[pd.isnull(obs[col]), col] = "nan"  # type: ignore
-            obs[col] = obs[col].astype(str)  # type: ignore
-
-        # using groupby instead of drop_duplicates since we need the group indices below
-        clonotype_groupby = obs.groupby(obs.columns.tolist(), sort=False, observed=True)
-        # This only gets the unique_values (the groupby index)
-        clonotypes = clonotype_groupby.size().index.to_frame(index=False)
+            obs[col] = self._as_str_categorical(obs[col])
 
-        if clonotypes.shape[0] == 0:
+        if obs.shape[0] == 0:
             raise ValueError(
                 "Error computing clonotypes. "
                 "No cells with IR information found (adata.obsm['chain_indices'] is None for all cells)"
             )
 
-        # groupby.indices gets us a (index -> array of row indices) mapping.
-        # It doesn't necessarily have the same order as `clonotypes`.
+        # Assign an integer id to each unique combination of values (=clonotype) by
+        # factorizing the columns one after another. Re-factorizing the combined key after
+        # each column keeps it smaller than the number of cells, so it can't overflow.
+        # `pd.factorize` is hash-based and numbers the clonotypes in order of appearance.
+        ct_ids = np.zeros(obs.shape[0], dtype=np.int64)
+        for col in obs.columns:
+            codes, uniques = pd.factorize(obs[col])
+            ct_ids, _ = pd.factorize(ct_ids * len(uniques) + codes)
+        n_clonotypes = np.max(ct_ids) + 1
+
+        # Sort cells by clonotype id. The cells of clonotype `i` start at
+        # position `starts[i]` of `order`.
+        order = np.argsort(ct_ids, kind="stable")
+        starts = np.searchsorted(ct_ids[order], np.arange(n_clonotypes))
+
+        # The first cell of each clonotype holds the unique values of that clonotype
+        clonotypes = obs.iloc[order[starts], :].reset_index(drop=True).astype(str)
+
         # This needs to be a dict of arrays, otherwiswe anndata
         # can't save it to h5ad.
         # Also the dict keys need to be of type `str`, or they'll get converted
         # implicitly.
-        cell_indices = {
-            str(i): obs.index[
-                clonotype_groupby.indices.get(
-                    # indices is not a tuple if it's just a single column.
-                    ct_tuple[0] if len(ct_tuple) == 1 else ct_tuple,
-                    [],
-                )
-            ].values
-            for i, ct_tuple in enumerate(clonotypes.itertuples(index=False, name=None))
-        }
+        # Splitting the sorted obs names once yields the cells of all clonotypes.
+        obs_names = obs.index.values[order]
+        cell_indices = {str(i): v for i, v in enumerate(np.split(obs_names, starts[1:]))}
 
         # make 'within group' a single column of tuples (-> only one distance
         # matrix instead of one per column.)
@@ -125,6 +248,12 @@ class ClonotypeNeighbors:
                 del clonotypes[tmp_col]
             clonotypes["match_columns"] = match_columns_col
 
+        # With `dual_ir="primary_only"`, there are no secondary chain columns and consequently
+        # no lookup tables for secondary chains.
+        assert "2" in self._dual_ir_cols or not any(
+            col.startswith(f"{arm}_2_") for col in clonotypes.columns for arm in self._receptor_arm_cols
+        ), "Secondary chains must not be referenced with dual_ir='primary_only'"
+
         # consistency check: there must not be a secondary chain if there is no
         # primary one:
         if "2" in self._dual_ir_cols:
@@ -137,6 +266,21 @@ class ClonotypeNeighbors:
 
         return cell_indices, clonotypes
 
+    @staticmethod
+    def _as_str_categorical(values: pd.Series) -> pd.Series:
+        """Convert a column into a categorical with `str` categories, where missing values
+        are represented as "nan".
+
+        The result is equivalent to `values.astype(str)` with all nans replaced by "nan", but
+        only the unique values need to be converted to `str`.
+        """
+        codes, uniques = pd.factorize(values)
+        str_uniques = np.append(np.array([str(x) for x in uniques], dtype=object), "nan")
+        codes[codes == -1] = len(str_uniques) - 1
+        # converting to str may introduce duplicates (e.g. `1` and `"1"`)
+        str_codes, categories = pd.factorize(str_uniques)
+        return pd.Series(pd.Categorical.from_codes(str_codes[codes], categories), index=values.index)
+
     def _add_distance_matrices(self) -> None:
         """Add all required distance matrices to the DoubleLookupNeighborFinder"""
         # sequence distance matrices
@@ -176,7 +320,8 @@ class ClonotypeNeighbors:
     @staticmethod
     def _unique_values_in_multiple_columns(df: pd.DataFrame, columns: Sequence[str]) -> set:
         """Return the Union of unique values of multiple columns of a dataframe"""
-        return set(np.concatenate([df[c].values.astype(str) for c in columns]))
+        # only the unique values of each column are converted, rather than concatenating all values first
+        return {str(x) for c in columns for x in pd.unique(df[c].values)}
 
     def _add_lookup_tables(self) -> None:
         """Add all required lookup tables to the DoubleLookupNeighborFinder"""
@@ -195,11 +340,25 @@ class ClonotypeNeighbors:
                 "match_columns", "match_columns", "match_columns", dist_type="boolean"
             )
 
-    def _make_chain_count(self, clonotype_table) -> dict[str, int]:
-        """Compute how many chains there are of each type."""
-        cols = {arm: [f"{arm}_{c}_{self.sequence_key}" for c in self._dual_ir_cols] for arm in self._receptor_arm_cols}
+    def _make_nan_mask(self, clonotype_table) -> dict[str, np.ndarray]:
+        """Compute a boolean mask for each sequence column that indicates which clonotypes have no sequence."""
+        return {
+            f"{arm}_{c}_{self.sequence_key}": clonotype_table[f"{arm}_{c}_{self.sequence_key}"].values == "nan"
+            for arm, c in itertools.product(self._receptor_arm_cols, self._dual_ir_cols)
+        }
+
+    def _make_chain_count(self, nan_mask: Mapping[str, np.ndarray]) -> dict[str, np.ndarray]:
+        """Compute how many chains there are of each type, based on the "nan" masks
+        of the sequence columns.
+        """
+        # the per-arm counts are only required to merge the chains with `dual_ir="all"`
+        cols = (
+            {arm: [f"{arm}_{c}_{self.sequence_key}" for c in self._dual_ir_cols] for arm in self._receptor_arm_cols}
+            if self.dual_ir == "all"
+            else {}
+        )
         cols["arms"] = [f"{arm}_1_{self.sequence_key}" for arm in self._receptor_arm_cols]
-        return {step: np.sum(clonotype_table.loc[:, cols].values != "nan", axis=1) for step, cols in cols.items()}
+        return {step: np.sum([~nan_mask[c] for c in cols], axis=0) for step, cols in cols.items()}
 
     def compute_distances(self) -> sp.csr_matrix:
         """Compute the distances between clonotypes.
@@ -211,30 +370,66 @@ class ClonotypeNeighbors:
         # only use multiprocessing for sufficiently large datasets
         # for small datasets the overhead is too large for a benefit
         if self.n_jobs == 1 or n_clonotypes <= 2 * self.chunksize:
-            dist_rows = tqdm(
-                (self._dist_for_clonotype(i) for i in range(n_clonotypes)),
-                total=n_clonotypes,
-            )
+            dist_chunks = [self._dist_for_clonotype_range(0, n_clonotypes, progress=True)]
         else:
             logging.info(
                 "NB: Computation happens in chunks. The progressbar only advances " "when a chunk has finished. "
             )  # type: ignore
 
-            dist_rows = process_map(
-                self._dist_for_clonotype,
-                range(n_clonotypes),
-                max_workers=self.n_jobs if self.n_jobs is not None else cpu_count(),
-                chunksize=2000,
-                tqdm_class=tqdm,
-            )
+            n_jobs = self.n_jobs if self.n_jobs is not None and self.n_jobs > 0 else cpu_count()
+            # Each task processes a contiguous range of `chunksize` clonotypes and returns
+            # the (row, col, data) triplets of all its distances. This way, the result is
+            # transferred back to the main process in one piece instead of pickling each row
+            # individually.
+            range_starts = range(0, n_clonotypes, self.chunksize)
+            range_stops = (min(i + self.chunksize, n_clonotypes) for i in range_starts)
+            # The instance is passed to each worker once via the initializer. With "fork", the
+            # workers inherit it from the parent process without copying. With other start methods,
+            # it is pickled, and the arrays are shared between the workers rather than copied
+            # into each of them.
+            mp_context = get_context()
+            with ExitStack() as stack:
+                stack.enter_context(self._dispatch_to_workers())
+                if mp_context.get_start_method() != "fork":
+                    try:
+                        stack.enter_context(self._shared_memory())
+                    except OSError:
+                        logging.warning(
+                            "Not enough shared memory available. The data is copied to each worker process instead."
+                        )  # type: ignore
+                with ProcessPoolExecutor(
+                    max_workers=n_jobs, mp_context=mp_context, initializer=_init_worker, initargs=(self,)
+                ) as executor:
+                    dist_chunks = list(
+                        tqdm(
+                            executor.map(_dist_for_clonotype_range_worker, range_starts, range_stops),
+                            total=len(range_starts),
+                        )
+                    )
 
-        dist = sp.vstack(list(dist_rows))
-        dist.eliminate_zeros()
+        # build the sparse matrix once from the triplets of all chunks
+        rows, cols, data = (np.concatenate(x) for x in zip(*dist_chunks))
+        dist = sp.coo_matrix((data, (rows, cols)), shape=(n_clonotypes, self.neighbor_finder.n_cols)).tocsr()
         logging.hint("Done computing clonotype x clonotype distances. ", time=start)
         return dist  # type: ignore
 
-    def _dist_for_clonotype(self, ct_id: int) -> sp.csr_matrix:
+    def _dist_for_clonotype_range(
+        self, start: int, stop: int, *, progress: bool = False
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Compute neighboring clonotypes for the clonotypes with ids `start` to `stop`.
+        Returns the row indices, column indices and distances as COO triplets.
+        """
+        ct_ids = range(start, stop)
+        dist_rows = [self._dist_for_clonotype(i) for i in (tqdm(ct_ids) if progress else ct_ids)]
+        rows = np.repeat(np.arange(start, stop), [len(indices) for indices, _ in dist_rows])
+        cols = np.concatenate([indices for indices, _ in dist_rows])
+        # distances fit into uint8; casting once per chunk avoids a copy per clonotype
+        data = np.concatenate([values for _, values in dist_rows]).astype(np.uint8)
+        return rows, cols, data
+
+    def _dist_for_clonotype(self, ct_id: int) -> tuple[np.ndarray, np.ndarray]:
         """Compute neighboring clonotypes for a given clonotype.
+        Returns the column indices of the neighbors and the respective (non-zero) distances.
 
         Or operations use the min dist of two matching entries.
         And operations use the max dist of two matching entries.
@@ -245,12 +440,10 @@ class ClonotypeNeighbors:
         match ("and"), the higher one should count.
         """
         # Lookup distances for current row
-        tmp_clonotypes = self.clonotypes2 if self.clonotypes2 is not None else self.clonotypes
         lookup = {}  # CDR3 distances
         lookup_v = {}  # V-gene distances
         for tmp_arm in self._receptor_arm_cols:
-            chain_ids = [(1, 1)] if self.dual_ir == "primary_only" else [(1, 1), (2, 2), (1, 2), (2, 1)]
-            for c1, c2 in chain_ids:
+            for c1, c2 in self._chain_ids:
                 lookup[(tmp_arm, c1, c2)] = self.neighbor_finder.lookup(
                     ct_id,
                     f"{tmp_arm}_{c1}",
@@ -264,63 +457,89 @@ class ClonotypeNeighbors:
                     )
 
         # need to loop through all coordinates that have at least one distance.
-        has_distance = merge_coo_matrices(lookup.values()).tocsr()  # type: ignore
-        # convert to csr matrices to iterate over indices
-        lookup = {k: v.tocsr() for k, v in lookup.items()}
+        # `np.unique` returns the sorted union of column indices of all lookups.
+        # The indices of a single lookup are already unique (each clonotype has a single
+        # value per column), which is the case for `dual_ir="primary_only"` with a single arm.
+        if len(lookup) == 1:
+            idx = np.sort(next(iter(lookup.values())).indices)  # type: ignore
+        else:
+            idx = np.unique(np.concatenate([x.indices for x in lookup.values()]))  # type: ignore
 
         def _lookup_dist_for_chains(tmp_arm: Literal["VJ", "VDJ"], c1: Literal[1, 2], c2: Literal[1, 2]):
             """Lookup the distance between two chains of a given receptor
             arm. Only considers those columns in the current row that
-            have an entry in `has_distance`. Returns a dense
+            have an entry in `idx`. Returns a dense
             array with dimensions (1, n) where n equals the number
-            of entries in `has_distance`.
+            of entries in `idx`. Clonotypes without the respective chain are
+            set to `NAN_DIST`.
             """
-            ct_col2 = tmp_clonotypes[f"{tmp_arm}_{c2}_{self.sequence_key}"].values
-            tmp_array = lookup[(tmp_arm, c1, c2)][0, has_distance.indices].todense().A1.astype(np.float16)
-            tmp_array[ct_col2[has_distance.indices] == "nan"] = np.nan
+            row = lookup[(tmp_arm, c1, c2)]
+            # the entries of each lookup are a subset of `idx`, so we can directly scatter them
+            # into a dense array
+            tmp_array = np.zeros(len(idx), dtype=np.uint16)
+            tmp_array[np.searchsorted(idx, row.indices)] = row.values
+            is_nan = self._nan_mask2[f"{tmp_arm}_{c2}_{self.sequence_key}"][idx]
+            tmp_array[is_nan] = NAN_DIST
             if self.same_v_gene:
-                mask_v_gene = lookup_v[(tmp_arm, c1, c2)][0, has_distance.indices]
-                tmp_array = np.multiply(tmp_array, mask_v_gene)
+                mask_v_gene = lookup_v[(tmp_arm, c1, c2)][0, idx]
+                tmp_array[~(mask_v_gene | is_nan)] = 0
             return tmp_array
 
-        # Merge the distances of chains
-        res = []
-        for tmp_arm in self._receptor_arm_cols:
-            if self.dual_ir == "primary_only":
-                tmp_res = _lookup_dist_for_chains(tmp_arm, 1, 1)
-            elif self.dual_ir == "all":
-                tmp_res = reduce_or(
-                    reduce_and(
-                        _lookup_dist_for_chains(tmp_arm, 1, 1),
-                        _lookup_dist_for_chains(tmp_arm, 2, 2),
-                        chain_count=self._chain_count[tmp_arm][ct_id],
-                    ),
-                    reduce_and(
-                        _lookup_dist_for_chains(tmp_arm, 1, 2),
-                        _lookup_dist_for_chains(tmp_arm, 2, 1),
-                        chain_count=self._chain_count[tmp_arm][ct_id],
-                    ),
-                )
-            else:  # "any"
-                tmp_res = reduce_or(
-                    _lookup_dist_for_chains(tmp_arm, 1, 1),
-                    _lookup_dist_for_chains(tmp_arm, 1, 2),
-                    _lookup_dist_for_chains(tmp_arm, 2, 2),
-                    _lookup_dist_for_chains(tmp_arm, 2, 1),
-                )
-
-            res.append(tmp_res)
-
-        # Merge the distances of arms.
-        reduce_fun = reduce_and if self.receptor_arms == "all" else reduce_or
-        # checking only the chain=1 columns here is enough, as there must not
-        # be a secondary chain if there is no first one.
-        res = reduce_fun(np.vstack(res), chain_count=self._chain_count["arms"][ct_id])
+        # Merge the distances of chains, and then the distances of arms.
+        res = self._merge_arms(
+            [self._merge_chains(_lookup_dist_for_chains, tmp_arm, ct_id, idx) for tmp_arm in self._receptor_arm_cols],
+            ct_id,
+        )
 
         if self.match_columns is not None:
             match_columns_mask = self.neighbor_finder.lookup(ct_id, "match_columns", "match_columns")
-            res = np.multiply(res, match_columns_mask[0, has_distance.indices])
+            res[~match_columns_mask[0, idx]] = 0
+
+        # Only keep actual neighbors. Clonotypes without any chain (if they were in `idx`)
+        # have no distance. Dropping the zeros here means the final matrix doesn't
+        # need to be scanned for explicit zeros again.
+        nz = (res != 0) & (res != NAN_DIST)
+        return idx[nz], res[nz]
+
+    # The following methods merge the distances of the chains of a receptor arm
+    # (one per `dual_ir` option) and the distances of the receptor arms (one per
+    # `receptor_arms` option). The matching ones are bound in `__init__` such that
+    # `_dist_for_clonotype` doesn't need to check the options for each clonotype.
+    # `lookup_dist` is a function that returns the distances for `(arm, c1, c2)`, `idx`
+    # are the column indices these distances refer to.
+
+    def _merge_chains_primary_only(
+        self, lookup_dist: Callable, tmp_arm: str, ct_id: int, idx: np.ndarray
+    ) -> np.ndarray:
+        return lookup_dist(tmp_arm, 1, 1)
+
+    def _merge_chains_all(self, lookup_dist: Callable, tmp_arm: str, ct_id: int, idx: np.ndarray) -> np.ndarray:
+        return reduce_chains_all(
+            lookup_dist(tmp_arm, 1, 1),
+            lookup_dist(tmp_arm, 2, 2),
+            lookup_dist(tmp_arm, 1, 2),
+            lookup_dist(tmp_arm, 2, 1),
+            chain_count=self._chain_count[tmp_arm][ct_id],
+            target_chain_count=self._chain_count2[tmp_arm][idx],
+        )
+
+    def _merge_chains_any(self, lookup_dist: Callable, tmp_arm: str, ct_id: int, idx: np.ndarray) -> np.ndarray:
+        # `lookup_dist` returns a new array, it can be used as accumulator. The others
+        # are reduced into it one by one instead of stacking all of them.
+        res = lookup_dist(tmp_arm, 1, 1)
+        for c1, c2 in [(1, 2), (2, 2), (2, 1)]:
+            reduce_or_into(res, lookup_dist(tmp_arm, c1, c2))
+        return res
+
+    def _merge_arms_single(self, res: Sequence[np.ndarray], ct_id: int) -> np.ndarray:
+        # reducing a single array by OR is a no-op
+        return res[0]
+
+    def _merge_arms_all(self, res: Sequence[np.ndarray], ct_id: int) -> np.ndarray:
+        # checking only the chain=1 columns here is enough, as there must not
+        # be a secondary chain if there is no first one.
+        return reduce_and(*res, chain_count=self._chain_count["arms"][ct_id])
 
-        final_res = has_distance.copy()
-        final_res.data = res.astype(np.uint8)
-        return final_res
+    def _merge_arms_any(self, res: Sequence[np.ndarray], ct_id: int) -> np.ndarray:
+        # the arrays in `res` are not used elsewhere, reduce into the first one
+        return reduce_or_into(res[0], *res[1:])
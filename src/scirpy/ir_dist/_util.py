@@ -1,94 +1,242 @@
-import warnings
-from collections.abc import Hashable, Mapping, Sequence
-from functools import reduce
-from operator import mul
-from typing import Literal, Optional, Union
-
+import copy
+import errno
+import os
+import shutil
+from collections.abc import Hashable, Iterator, Mapping, Sequence
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Literal, NamedTuple, Optional, Union
+
+import numba as nb
 import numpy as np
 import pandas as pd
 import scipy.sparse as sp
-from scipy.sparse import coo_matrix, csr_matrix
-
+from scipy.sparse import csr_matrix
 
-def merge_coo_matrices(mats: Sequence[coo_matrix], shape=None) -> coo_matrix:
-    """Fast sum of coo_matrices. Equivalent to builtin function `sum()`, but faster.
+#: Sentinel for missing entries (e.g. the clonotype does not have a secondary chain)
+#: in distance arrays of dtype uint16. Distances are small integers, so this value can't
+#: be a valid distance.
+NAN_DIST = np.iinfo(np.uint16).max
 
-    The only execption is that while `sum` procudes `0` on an empty list, this function
-    returns an empty coo matrix with shape `(0, 0)`. This makes downstream operations
-    more consistent.
 
-    This function makes use of the fact that COO matrices can have multiple entries
-    for the same coordinates. When converting them to a different sparse matrix type
-    they will be summed up internally.
+def _check_uint16(args) -> None:
+    """Raise a `TypeError` if one of the arrays is not of dtype uint16.
 
-    Parameters
-    ----------
-    mats
-        Sequence of COO matrices
-    shape
-        Expected output shape. If None will infer from the input
-        sequence. Will raise an error if one of the matrices is not consistent with
-        the shape.
+    Float distances are not supported, as they can't be represented without loss in uint16.
     """
-    mats = list(mats)
+    for arr in args:
+        if arr.dtype != np.uint16:
+            raise TypeError(f"Expected arrays of dtype uint16 (missing values are `NAN_DIST`), got {arr.dtype}.")
 
-    # check that shapes are consistent. matrices with shape 0 are ignored.
-    for mat in mats:
-        if mat.shape == (0, 0):
-            continue
-        elif shape is None:
-            shape = mat.shape
-        else:
-            if mat.shape != shape:
-                raise ValueError("Incompatible shapes")
 
-    # sum is 0 if all inputs are 0 or the shape is 0 in one dimension
-    if not len(mats) or shape is None or reduce(mul, shape) == 0:
-        return coo_matrix((0, 0) if shape is None else shape)
+def _stack_uint16(args) -> np.ndarray:
+    """Stack 1D arrays of dtype uint16 into a 2D array."""
+    _check_uint16(args)
+    return np.vstack(args)
 
-    data, row, col = zip(*((x.data, x.row, x.col) for x in mats))
 
-    return sp.coo_matrix((np.hstack(data), (np.hstack(row), np.hstack(col))), shape=shape)
+@nb.njit(cache=True)
+def _reduce_and(arr, chain_count):
+    """Column-wise maximum of a 2D uint16 array, ignoring `NAN_DIST`. Columns that contain a 0
+    or where the number of entries that are not `NAN_DIST` differs from `chain_count` are 0.
+
+    Columns that only contain `NAN_DIST` are `NAN_DIST`.
+    """
+    out = np.zeros(arr.shape[1], dtype=np.uint16)
+    for j in range(arr.shape[1]):
+        m = 0
+        n_not_nan = 0
+        has_zero = False
+        for i in range(arr.shape[0]):
+            v = arr[i, j]
+            if v == NAN_DIST:
+                continue
+            n_not_nan += 1
+            if v == 0:
+                has_zero = True
+            elif v > m:
+                m = v
+        if n_not_nan == 0:
+            out[j] = NAN_DIST
+        elif n_not_nan == chain_count[j] and not has_zero:
+            out[j] = m
+    return out
+
+
+@nb.njit(cache=True)
+def _reduce_or_into(out, arr):
+    """Element-wise OR of two uint16 arrays as if they were boolean: Take minimum, ignore 0s
+    and `NAN_DIST`. Entries that are `NAN_DIST` in both arrays stay `NAN_DIST`. The result is
+    written to `out`.
+
+    This corresponds to a minimum with respect to the order `1 < 2 < ... < 0 < NAN_DIST`,
+    therefore it can be applied to one array after another.
+    """
+    for j in range(out.shape[0]):
+        a = out[j]
+        b = arr[j]
+        if b == NAN_DIST:
+            continue
+        if a == NAN_DIST or a == 0 or (b != 0 and b < a):
+            out[j] = b
+    return out
 
 
-def reduce_or(*args, chain_count=None):
-    """Reduce two or more (sparse) masys by OR as if they were boolean:
+def reduce_or_into(out: np.ndarray, *args: np.ndarray) -> np.ndarray:
+    """Reduce one or more uint16 arrays by OR into `out`, as if they were boolean:
     Take minimum, ignore 0s and nans.
 
-    All arrays must be of a float dtype (to support nan and inf)
+    Modifies `out` in place. Only supports arrays of dtype uint16 (missing values are `NAN_DIST`).
     """
-    # ignore runtime warnings due to NAN-slices
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", category=RuntimeWarning)
-
-        tmp_array = np.vstack(args)
-        assert np.issubdtype(tmp_array.dtype, np.floating)
-        tmp_array[tmp_array == 0] = np.inf
-        tmp_array = np.nanmin(tmp_array, axis=0)
-        tmp_array[np.isinf(tmp_array)] = 0
-        return tmp_array
+    _check_uint16((out, *args))
+    for arr in args:
+        _reduce_or_into(out, arr)
+    return out
 
 
 def reduce_and(*args, chain_count):
     """Reduce two or more (sparse) masks by AND as if they were boolean:
     Take maximum, ignore nans.
 
-    All arrays must be of a float dtype (to support nan and inf)
+    Arrays must be of dtype uint16 (missing values are `NAN_DIST`).
 
     Only entries that have the same chain count (e.g. clonotypes with both TRA_1
     and TRA_2) are comparable.
     """
-    # ignore runtime warnings due to NAN-slices
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", category=RuntimeWarning)
-
-        tmp_array = np.vstack(args)
-        assert np.issubdtype(tmp_array.dtype, np.floating)
-        tmp_array[tmp_array == 0] = np.inf
-        same_count_mask = np.sum(~np.isnan(tmp_array), axis=0) == chain_count
-        tmp_array = np.nanmax(tmp_array, axis=0)
-        tmp_array[np.isinf(tmp_array)] = 0
-        tmp_array = np.multiply(tmp_array, same_count_mask)
+    tmp_array = _stack_uint16(args)
+    chain_count = np.broadcast_to(chain_count, tmp_array.shape[1])
+    return _reduce_and(tmp_array, chain_count)
+
+
+@nb.njit(cache=True, nogil=True)
+def _gather_neighbors(row_indices, row_data, indptr, indices):
+    """Gather the neighbors of several keys of a reverse lookup table in CSR format
+    (see `ReverseLookupTable`) in a single pass.
+
+    Returns the concatenated indices of the neighbors of all keys in `row_indices` and,
+    aligned with them, the value in `row_data` of the respective key. Keys that are not
+    in the table don't have any neighbors.
+    """
+    n_keys = indptr.shape[0] - 1
+    n = 0
+    for k in row_indices:
+        if k < n_keys:
+            n += indptr[k + 1] - indptr[k]
+    out_indices = np.empty(n, dtype=indices.dtype)
+    out_values = np.empty(n, dtype=row_data.dtype)
+    p = 0
+    for i in range(row_indices.shape[0]):
+        k = row_indices[i]
+        if k >= n_keys:
+            continue
+        for j in range(indptr[k], indptr[k + 1]):
+            out_indices[p] = indices[j]
+            out_values[p] = row_data[i]
+            p += 1
+    return out_indices, out_values
+
+
+@nb.njit(cache=True)
+def _reduce_chains_all(d11, d22, d12, d21, chain_count, target_chain_count):
+    """See `reduce_chains_all`"""
+    out = np.zeros(d11.shape[0], dtype=np.uint16)
+    for j in range(d11.shape[0]):
+        if target_chain_count[j] == 0:
+            out[j] = NAN_DIST
+            continue
+        if target_chain_count[j] != chain_count:
+            continue
+        res = 0
+        for a, b in ((d11[j], d22[j]), (d12[j], d21[j])):
+            # AND of the chains the target clonotype has (i.e. the entries that are not `NAN_DIST`)
+            if a == NAN_DIST:
+                m = b
+            elif b == NAN_DIST:
+                m = a
+            elif a == 0 or b == 0:
+                m = 0
+            else:
+                m = max(a, b)
+            # OR of the two pairings
+            if m != 0 and (res == 0 or m < res):
+                res = m
+        out[j] = res
+    return out
+
+
+def reduce_chains_all(d11, d22, d12, d21, *, chain_count: int, target_chain_count: np.ndarray) -> np.ndarray:
+    """Merge the distances of the chains of a receptor arm for `dual_ir="all"`.
+
+    Equivalent to
+
+    .. code-block:: python
+
+        reduce_or_into(
+            reduce_and(d11, d22, chain_count=chain_count),
+            reduce_and(d12, d21, chain_count=chain_count),
+        )
+
+    in a single pass, for uint16 arrays where `dXY` are the distances of chain X of the
+    query clonotype to chain Y of the target clonotypes and target clonotypes without chain Y
+    are `NAN_DIST`. Instead of counting the entries which are not `NAN_DIST`, this
+    uses the number of chains of each target clonotype (`target_chain_count`),
+    which is the same. Columns with a different number of chains than `chain_count` are
+    therefore skipped without looking at the distances.
+    """
+    return _reduce_chains_all(d11, d22, d12, d21, chain_count, target_chain_count)
+
+
+def _to_shared_memory(arr: np.ndarray, handles: list[SharedMemory]) -> tuple[str, tuple, str]:
+    """Copy an array into a new shared memory block.
+
+    The handle of the block is appended to `handles`. Returns a picklable
+    specification `(name, shape, dtype)` that can be passed to `_from_shared_memory`.
+    Raises an `OSError` if there is not enough shared memory available.
+    """
+    # Creating a block only reserves the size. If the tmpfs backing the block is too small,
+    # writing to it fails with SIGBUS instead of an exception, therefore check the space beforehand.
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free < arr.nbytes:
+        raise OSError(errno.ENOSPC, "Not enough space in /dev/shm for a shared memory block")
+    # size 0 is not allowed for shared memory blocks
+    shm = SharedMemory(create=True, size=max(arr.nbytes, 1))
+    handles.append(shm)
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm.name, arr.shape, arr.dtype.str
+
+
+def _release_shared_memory(handles: Sequence[SharedMemory]) -> None:
+    """Close and unlink shared memory blocks created by `_to_shared_memory`."""
+    for shm in handles:
+        shm.close()
+        shm.unlink()
+
+
+def _from_shared_memory(spec: tuple[str, tuple, str], handles: list[SharedMemory]) -> np.ndarray:
+    """Attach to an array created by `_to_shared_memory` without copying it.
+
+    The handle of the block is appended to `handles` and must be kept alive as long as the array is used.
+    """
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    handles.append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class LookupRow(NamedTuple):
+    """A sparse row of neighbors, stored as two aligned arrays.
+
+    `indices` holds the (not necessarily sorted) column indices of the neighbors,
+    `values` the respective distances. `size` is the total length of the row.
+    """
+
+    indices: np.ndarray
+    values: np.ndarray
+    size: int
+
+    def toarray(self) -> np.ndarray:
+        """Convert the row into a dense 1D array"""
+        tmp_array = np.zeros(self.size, dtype=self.values.dtype)
+        tmp_array[self.indices] = self.values
         return tmp_array
 
 
@@ -99,7 +247,7 @@ class ReverseLookupTable:
 
         It respects two types:
             * boolean -> dense boolean mask
-            * numeric -> sparse integer row
+            * numeric -> array of (int32) indices
 
         The boolean mask is the more efficient option for features with many
         neighbors per value (e.g. most of the cells may be of receptor_type TCR).
@@ -118,7 +266,22 @@ class ReverseLookupTable:
             raise ValueError("invalid dist_type")
         self.dist_type = dist_type
         self.size = size
-        self.lookup: dict[Hashable, sp.coo_matrix] = {}
+        self.lookup: dict[Hashable, np.ndarray] = {}
+        # Numeric tables with integer keys additionally hold all index arrays in CSR format,
+        # i.e. the indices for key `k` are `indices[indptr[k] : indptr[k + 1]]`. The arrays
+        # in `lookup` are views into `indices`. This allows to gather the neighbors of
+        # several keys at once in compiled code.
+        self.indptr: Optional[np.ndarray] = None
+        self.indices: Optional[np.ndarray] = None
+        # Boolean tables hold all masks as rows of a single 2D array. The masks in `lookup`
+        # are views of the rows, in the order of `keys`.
+        self.masks: Optional[np.ndarray] = None
+        # The keys of `lookup` if it consists of views into the arrays above.
+        # Pickling doesn't preserve views, they are restored from the arrays instead.
+        self.keys: Optional[list] = None
+
+    #: attributes that hold the data of the table if `keys` is set
+    ARRAY_ATTRS = ("indptr", "indices", "masks")
 
     @staticmethod
     def from_dict_of_indices(
@@ -139,22 +302,60 @@ class ReverseLookupTable:
         """
         rlt = ReverseLookupTable(dist_type, size)
 
-        # convert into coo matrices (numeric distances) or numpy boolean arrays.
-        for k, v in dict_of_indices.items():
-            if rlt.is_boolean:
-                tmp_array = np.zeros(shape=(1, size), dtype=bool)
-                tmp_array[0, v] = True
-                rlt.lookup[k] = tmp_array
-            else:
-                rlt.lookup[k] = sp.coo_matrix(
-                    (
-                        np.ones(len(v), dtype=np.uint8),
-                        (np.zeros(len(v), dtype=int), v),
-                    ),
-                    shape=(1, size),
-                )
+        # convert into numpy boolean arrays ...
+        if rlt.is_boolean:
+            rlt.keys = list(dict_of_indices)
+            rlt.masks = np.zeros(shape=(len(rlt.keys), size), dtype=bool)
+            for i, v in enumerate(dict_of_indices.values()):
+                rlt.masks[i, v] = True
+            rlt._restore_lookup()
+        # ... or index arrays (numeric distances)
+        elif all(isinstance(k, (int, np.integer)) and k >= 0 for k in dict_of_indices):
+            rlt.keys = list(dict_of_indices)
+            sorted_keys = sorted(rlt.keys)
+            lengths = [len(dict_of_indices[k]) for k in sorted_keys]
+            rlt.indptr = np.zeros(sorted_keys[-1] + 2 if len(sorted_keys) else 1, dtype=np.int64)
+            rlt.indptr[np.array(sorted_keys, dtype=np.int64) + 1] = lengths
+            np.cumsum(rlt.indptr, out=rlt.indptr)
+            rlt.indices = np.zeros(rlt.indptr[-1], dtype=np.int32)
+            rlt._restore_lookup()
+            for k, v in dict_of_indices.items():
+                rlt.lookup[k][:] = v
+        else:
+            for k, v in dict_of_indices.items():
+                rlt.lookup[k] = np.array(v, dtype=np.int32)
+        return rlt
+
+    def _restore_lookup(self) -> None:
+        """(Re-)create `lookup` as views into the arrays that hold the data of the table"""
+        if self.masks is not None:
+            self.lookup = {k: self.masks[i : i + 1] for i, k in enumerate(self.keys)}  # type: ignore
+        elif self.indptr is not None:
+            self.lookup = {k: self.indices[self.indptr[k] : self.indptr[k + 1]] for k in self.keys}  # type: ignore
+
+    def without_arrays(self) -> "ReverseLookupTable":
+        """Return a shallow copy without the arrays that hold the data of the table.
+
+        The arrays need to be set again (followed by `_restore_lookup`) before the copy can be used.
+        """
+        rlt = copy.copy(self)
+        if rlt.keys is not None:
+            for attr in self.ARRAY_ATTRS:
+                setattr(rlt, attr, None)
+            rlt.lookup = {}
         return rlt
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.keys is not None:
+            # restored as views in `__setstate__`
+            state["lookup"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._restore_lookup()
+
     @property
     def is_boolean(self):
         return self.dist_type == "boolean"
@@ -166,7 +367,7 @@ class ReverseLookupTable:
         if self.is_boolean:
             return np.zeros((1, self.size), dtype=bool)
         else:
-            return sp.coo_matrix((1, self.size))
+            return np.zeros(0, dtype=np.int32)
 
     def __getitem__(self, i):
         """Get mask for index `i`"""
@@ -222,6 +423,9 @@ class DoubleLookupNeighborFinder:
         # forward: clonotype -> feature_index lookups
         # reverse: feature_index -> clonotype lookups
         self.lookups: dict[str, tuple[str, np.ndarray, ReverseLookupTable]] = {}
+        # specification of the arrays in shared memory, see `shared_memory`
+        self._shared_arrays: Optional[dict[str, dict]] = None
+        self._shared_memory_handles: list[SharedMemory] = []
 
     @property
     def n_rows(self):
@@ -231,12 +435,83 @@ class DoubleLookupNeighborFinder:
     def n_cols(self):
         return self.feature_table2.shape[0]
 
+    @contextmanager
+    def shared_memory(self) -> Iterator["DoubleLookupNeighborFinder"]:
+        """Context manager that places the distance matrices and lookup tables in shared memory.
+
+        While active, pickling the object (e.g. to send it to worker processes) only
+        transfers references to the shared memory blocks instead of copying the arrays.
+        Unpickled copies attach to the shared memory blocks and can be used for `lookup`,
+        but not for adding distance matrices or lookup tables. The blocks are released
+        when the context exits.
+        """
+        handles: list[SharedMemory] = []
+        try:
+            self._shared_arrays = {
+                "distance_matrices": {
+                    name: (
+                        mat.shape,
+                        tuple(_to_shared_memory(getattr(mat, attr), handles) for attr in ["data", "indices", "indptr"]),
+                    )
+                    for name, mat in self.distance_matrices.items()
+                },
+                "lookups": {
+                    name: (
+                        _to_shared_memory(forward, handles),
+                        {
+                            attr: _to_shared_memory(getattr(reverse, attr), handles)
+                            for attr in reverse.ARRAY_ATTRS
+                            if reverse.keys is not None and getattr(reverse, attr) is not None
+                        },
+                    )
+                    for name, (_, forward, reverse) in self.lookups.items()
+                },
+            }
+            yield self
+        finally:
+            self._shared_arrays = None
+            _release_shared_memory(handles)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shared_memory_handles"] = []
+        if self._shared_arrays is not None:
+            # the arrays are restored from shared memory in `__setstate__`
+            state["distance_matrices"] = None
+            state["lookups"] = {
+                name: (distance_matrix, None, reverse.without_arrays())
+                for name, (distance_matrix, _, reverse) in self.lookups.items()
+            }
+            # The features and their labels are only required for building lookup tables.
+            # Empty data frames keep the number of rows.
+            state["feature_table"] = self.feature_table.iloc[:, :0]
+            state["feature_table2"] = self.feature_table2.iloc[:, :0]
+            state["distance_matrix_labels"] = state["distance_matrix_labels2"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_arrays is not None:
+            handles = self._shared_memory_handles
+            self.distance_matrices = {
+                name: csr_matrix(tuple(_from_shared_memory(spec, handles) for spec in arrays), shape=shape)
+                for name, (shape, arrays) in self._shared_arrays["distance_matrices"].items()
+            }
+            for name, (forward_spec, reverse_specs) in self._shared_arrays["lookups"].items():
+                distance_matrix, _, reverse = self.lookups[name]
+                for attr, spec in reverse_specs.items():
+                    setattr(reverse, attr, _from_shared_memory(spec, handles))
+                reverse._restore_lookup()
+                self.lookups[name] = (distance_matrix, _from_shared_memory(forward_spec, handles), reverse)
+            # the copy is independent of the shared memory context of the original object
+            self._shared_arrays = None
+
     def lookup(
         self,
         object_id: int,
         forward_lookup_table: str,
         reverse_lookup_table: Union[str, None] = None,
-    ) -> Union[coo_matrix, np.ndarray]:
+    ) -> Union[LookupRow, np.ndarray]:
         """Get ids of neighboring objects from a lookup table.
 
         Performs the following lookup:
@@ -248,6 +523,9 @@ class DoubleLookupNeighborFinder:
         "nan"s are not looked up via the distance matrix, they return a row of zeros
         instead.
 
+        Numeric lookup tables return a :class:`LookupRow` with the indices and distances
+        of the neighbors, boolean lookup tables a dense boolean mask of shape `(1, n_cols)`.
+
         Parameters
         ----------
         object_id
@@ -271,22 +549,32 @@ class DoubleLookupNeighborFinder:
         distance_matrix = self.distance_matrices[distance_matrix_name]
         idx_in_dist_mat = forward[object_id]
         if idx_in_dist_mat == -1:  # nan
-            return reverse.empty()
+            empty = reverse.empty()
+            if reverse.is_boolean:
+                return empty
+            return LookupRow(empty, np.zeros(0, dtype=distance_matrix.dtype), reverse.size)
         else:
-            # get distances from the distance matrix...
-            row = distance_matrix[idx_in_dist_mat, :]
+            # get distances from the distance matrix directly from the CSR arrays
+            # (avoids creating a sparse row object)...
+            row_start, row_end = distance_matrix.indptr[idx_in_dist_mat : idx_in_dist_mat + 2]
+            row_indices = distance_matrix.indices[row_start:row_end]
+            row_data = distance_matrix.data[row_start:row_end]
 
             if reverse.is_boolean:
-                assert (
-                    len(row.indices) == 1  # type: ignore
-                ), "Boolean reverse lookup only works for identity distance matrices."
-                return reverse[row.indices[0]]  # type: ignore
+                assert len(row_indices) == 1, "Boolean reverse lookup only works for identity distance matrices."
+                return reverse[row_indices[0]]
+            elif reverse.indptr is not None:
+                # ... and get the neighboring objects of all neighboring features at once
+                return LookupRow(
+                    *_gather_neighbors(row_indices, row_data, reverse.indptr, reverse.indices), reverse.size
+                )
             else:
-                # ... and get column indices directly from sparse row
-                # sum concatenates coo matrices
-                return merge_coo_matrices(
-                    (reverse[i] * multiplier for i, multiplier in zip(row.indices, row.data)),  # type: ignore
-                    shape=(1, reverse.size),
+                # ... and get the neighboring objects of each neighboring feature
+                neighbors = [reverse[i] for i in row_indices]
+                return LookupRow(
+                    np.concatenate(neighbors) if len(neighbors) else reverse.empty(),
+                    np.repeat(row_data, [len(x) for x in neighbors]),
+                    reverse.size,
                 )
 
     def add_distance_matrix(
@@ -356,9 +644,9 @@ class DoubleLookupNeighborFinder:
         """Create a lookup array that maps each clonotype to the respective
         index in the feature distance matrix.
         """
-        return np.array(
-            [self.distance_matrix_labels[distance_matrix][k] for k in self.feature_table[feature_col]],
-        )
+        # only the unique values need to be looked up, the codes map them back to the rows
+        codes, uniques = pd.factorize(self.feature_table[feature_col])
+        return np.array([self.distance_matrix_labels[distance_matrix][k] for k in uniques], dtype=int)[codes]
 
     def _build_reverse_lookup_table(
         self,
@@ -372,17 +660,16 @@ class DoubleLookupNeighborFinder:
         If the dist_type is numeric, will use a sparse numeric matrix.
         If the dist_type is boolean, use a dense boolean.
         """
-        tmp_reverse_lookup = {}
         tmp_index_lookup = self.distance_matrix_labels2[distance_matrix]
-
-        # Build reverse lookup
-        for i, k in enumerate(self.feature_table2[feature_col]):
-            tmp_key = tmp_index_lookup[k]
-            if tmp_key == -1:
-                continue
-            try:
-                tmp_reverse_lookup[tmp_key].append(i)
-            except KeyError:
-                tmp_reverse_lookup[tmp_key] = [i]
+        codes, uniques = pd.factorize(self.feature_table2[feature_col])
+        # index in the distance matrix for each row of the feature table
+        keys = np.array([tmp_index_lookup[k] for k in uniques], dtype=int)[codes]
+
+        # Build reverse lookup by grouping the row indices by key
+        order = np.argsort(keys, kind="stable")
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        tmp_reverse_lookup = {
+            int(k): v for k, v in zip(unique_keys, np.split(order, starts[1:])) if k != -1  # -1 is nan
+        }
 
         return ReverseLookupTable.from_dict_of_indices(tmp_reverse_lookup, dist_type, self.n_cols)
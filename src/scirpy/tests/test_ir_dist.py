@@ -1,3 +1,8 @@
+import copy
+import errno
+import multiprocessing
+import pickle
+
 import joblib
 import numpy as np
 import numpy.testing as npt
@@ -430,6 +435,93 @@ def test_compute_distances_2(
     npt.assert_equal(dist, expected)
 
 
+@pytest.mark.parametrize("with_adata2", [False, True])
+def test_clonotype_neighbors_shared_memory(adata_cdr3, adata_cdr3_mock_distance_calculator, with_adata2):
+    """Test that a pickled ClonotypeNeighbors instance (as sent to worker processes with
+    start methods other than "fork") computes the same distances from shared memory
+    """
+    adata2 = adata_cdr3 if with_adata2 else None
+    ir.pp.ir_dist(adata_cdr3, adata2, metric=adata_cdr3_mock_distance_calculator, sequence="aa", key_added="ir_dist")
+    cn = ClonotypeNeighbors(
+        DataHandler.default(adata_cdr3),
+        DataHandler.default(adata2),
+        receptor_arms="all",
+        dual_ir="all",
+        same_v_gene=True,
+        distance_key="ir_dist",
+        sequence_key="junction_aa",
+    )
+    n_clonotypes = cn.clonotypes.shape[0]
+    expected = cn._dist_for_clonotype_range(0, n_clonotypes)
+    with cn._dispatch_to_workers(), cn._shared_memory():
+        state = pickle.dumps(cn)
+        cn2 = pickle.loads(state)
+        for actual_arr, expected_arr in zip(cn2._dist_for_clonotype_range(0, n_clonotypes), expected):
+            npt.assert_equal(actual_arr, expected_arr)
+        # only the number of clonotypes is sent along, not the clonotype table itself
+        assert cn2.clonotypes.shape == (n_clonotypes, 0)
+        del cn2
+
+
+@pytest.mark.parametrize("with_adata2", [False, True])
+def test_clonotype_neighbors_pickle(adata_cdr3, adata_cdr3_mock_distance_calculator, with_adata2):
+    """Test that pickling and copying a ClonotypeNeighbors instance outside of
+    `compute_distances` is lossless
+    """
+    adata2 = adata_cdr3 if with_adata2 else None
+    ir.pp.ir_dist(adata_cdr3, adata2, metric=adata_cdr3_mock_distance_calculator, sequence="aa", key_added="ir_dist")
+    cn = ClonotypeNeighbors(
+        DataHandler.default(adata_cdr3),
+        DataHandler.default(adata2),
+        receptor_arms="all",
+        dual_ir="all",
+        distance_key="ir_dist",
+        sequence_key="junction_aa",
+    )
+    expected = cn.compute_distances().toarray()
+    for cn2 in [pickle.loads(pickle.dumps(cn)), copy.deepcopy(cn)]:
+        _assert_frame_equal(cn2.clonotypes, cn.clonotypes)
+        assert cn2.cell_indices == cn.cell_indices
+        assert cn2.distance_dict.keys() == cn.distance_dict.keys()
+        npt.assert_equal(cn2.compute_distances().toarray(), expected)
+
+
+@pytest.mark.parametrize("shared_memory_available", [True, False])
+@pytest.mark.parametrize("with_adata2", [False, True])
+def test_compute_distances_spawn(
+    adata_cdr3, adata_cdr3_mock_distance_calculator, with_adata2, shared_memory_available, monkeypatch
+):
+    """Test that the workers of a "spawn" pool compute the same distances as the main process,
+    both from shared memory and from a copy of the data if shared memory is not available.
+    """
+    adata2 = adata_cdr3 if with_adata2 else None
+    ir.pp.ir_dist(adata_cdr3, adata2, metric=adata_cdr3_mock_distance_calculator, sequence="aa", key_added="ir_dist")
+
+    def _compute_distances(n_jobs):
+        cn = ClonotypeNeighbors(
+            DataHandler.default(adata_cdr3),
+            DataHandler.default(adata2),
+            receptor_arms="all",
+            dual_ir="all",
+            distance_key="ir_dist",
+            sequence_key="junction_aa",
+            n_jobs=n_jobs,
+            chunksize=1,
+        )
+        return cn.compute_distances().toarray()
+
+    expected = _compute_distances(1)
+
+    def _no_shared_memory(*args, **kwargs):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr("scirpy.ir_dist._clonotype_neighbors.get_context", lambda: multiprocessing.get_context("spawn"))
+    if not shared_memory_available:
+        monkeypatch.setattr("scirpy.ir_dist._clonotype_neighbors._to_shared_memory", _no_shared_memory)
+        monkeypatch.setattr("scirpy.ir_dist._util._to_shared_memory", _no_shared_memory)
+    npt.assert_equal(_compute_distances(2), expected)
+
+
 def test_compute_distances_no_ir(adata_cdr3, adata_cdr3_mock_distance_calculator):
     """Test for #174. Gracefully handle the case when there are no IR."""
     # reset chain indices such that they point to no chains whatsoever.
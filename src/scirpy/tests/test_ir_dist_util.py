@@ -1,12 +1,21 @@
 """Test ir_dist._util utility functions"""
 
+import pickle
+
 import numpy as np
 import numpy.testing as npt
 import pandas as pd
 import pytest
 import scipy.sparse as sp
 
-from scirpy.ir_dist._util import DoubleLookupNeighborFinder, merge_coo_matrices, reduce_and, reduce_or
+from scirpy.ir_dist._util import (
+    NAN_DIST,
+    DoubleLookupNeighborFinder,
+    ReverseLookupTable,
+    reduce_and,
+    reduce_chains_all,
+    reduce_or_into,
+)
 
 
 @pytest.fixture
@@ -75,26 +84,10 @@ def dlnf_with_lookup(request):
     return dlnf
 
 
-@pytest.mark.parametrize(
-    "mats",
-    [
-        ([1, 2, 3], [1, 2, 3]),
-        ([1, 2, 3, 4], [0, 0, 0, 0]),
-        ([1, 2, 3, 4], [8, 8, 8, 8], [4, 4, 4, 4]),
-        ([0, 0, 0, 0]),
-        ([]),
-    ],
-)
-def test_merge_coo_matrices(mats):
-    """Test that the fast sum equals the builtin sum"""
-    mats = [sp.coo_matrix(m) for m in mats]
-    res = merge_coo_matrices(mats)
-    # empty lists stay empty list
-    expected = sum(mats) if len(mats) else sp.coo_matrix((0, 0))
-    try:
-        npt.assert_equal(res.toarray(), expected.toarray())
-    except AttributeError:
-        assert res == expected
+def _as_uint16(values) -> np.ndarray:
+    """Convert a list of distances, where nan marks missing values, to the uint16 representation"""
+    values = np.array(values, dtype=float)
+    return np.where(np.isnan(values), NAN_DIST, values).astype(np.uint16)
 
 
 @pytest.mark.parametrize(
@@ -108,12 +101,15 @@ def test_merge_coo_matrices(mats):
         ([[0, 2, np.nan, 0], [0, 1, 0, 5], [7, 0, 0, 3]], [7, 1, 0, 3]),
         ([[np.nan, 2, 4, np.nan], [0, np.nan, 0, 5]], [0, 2, 4, 5]),
         ([[np.nan, 2, 4, np.nan], [np.nan, np.nan, 0, 5]], [np.nan, 2, 4, 5]),
+        ([[np.nan, 2, 4, np.nan], [np.nan, np.nan, 0, 5], [np.nan, 0, np.nan, np.nan]], [np.nan, 2, 4, 5]),
     ],
 )
-def test_reduce_or(args, expected):
-    args = [np.array(a, dtype=np.float16) for a in args]
-    expected = np.array(expected, dtype=np.float16)
-    npt.assert_equal(reduce_or(*args), expected)
+def test_reduce_or_into(args, expected):
+    args = [_as_uint16(a) for a in args]
+    out = args[0].copy()
+    res = reduce_or_into(out, *args[1:])
+    assert res is out
+    npt.assert_equal(out, _as_uint16(expected))
 
 
 @pytest.mark.parametrize(
@@ -124,6 +120,7 @@ def test_reduce_or(args, expected):
         ([[0, 0, 1, 0], [0, 2, 4, 0]], [2, 2, 2, 2], [0, 0, 4, 0]),
         ([[0, 2, 4, 0], [0, 1, 5, 0]], [2, 2, 2, 2], [0, 2, 5, 0]),
         ([[3, 2, 4, 1], [3, 1, 5, 1]], [0, 1, 2, 3], [0, 0, 5, 0]),
+        ([[3, 2, 4, 1], [3, 1, 5, 1]], 2, [3, 2, 5, 1]),
         (
             [[0, 2, 4, 0], [0, 1, 5, 0], [0, 2, 4, 0], [0, 1, 7, 0]],
             [4, 4, 4, 4],
@@ -137,10 +134,63 @@ def test_reduce_or(args, expected):
     ],
 )
 def test_reduce_and(args, chain_count, expected):
-    args = [np.array(a, dtype=np.float16) for a in args]
-    expected = np.array(expected, dtype=np.float16)
+    args = [_as_uint16(a) for a in args]
     chain_count = np.array(chain_count, dtype=int)
-    npt.assert_equal(reduce_and(*args, chain_count=chain_count), expected)
+    npt.assert_equal(reduce_and(*args, chain_count=chain_count), _as_uint16(expected))
+
+
+def test_reduce_uint16():
+    """Reducing uint16 arrays uses `NAN_DIST` instead of nan to mark missing values"""
+    args = [
+        np.array([NAN_DIST, 2, 4, NAN_DIST], dtype=np.uint16),
+        np.array([NAN_DIST, NAN_DIST, 0, 5], dtype=np.uint16),
+    ]
+    npt.assert_equal(reduce_or_into(args[0].copy(), args[1]), np.array([NAN_DIST, 2, 4, 5], dtype=np.uint16))
+    npt.assert_equal(reduce_and(*args, chain_count=1), np.array([NAN_DIST, 2, 0, 5], dtype=np.uint16))
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        [np.array([0.5, 2.7, np.nan], dtype=np.float16), np.array([np.nan, 1.2, np.nan], dtype=np.float16)],
+        [np.array([0.5, 2.7, np.nan]), np.array([np.nan, 1.2, np.nan])],
+        [np.array([1, 70000, 0]), np.array([0, 4464, 3])],
+    ],
+)
+def test_reduce_wrong_dtype(args):
+    """Only uint16 arrays are supported, other dtypes can't be reduced without loss"""
+    with pytest.raises(TypeError):
+        reduce_and(*args, chain_count=2)
+    with pytest.raises(TypeError):
+        reduce_or_into(*args)
+
+
+@pytest.mark.parametrize("chain_count", [0, 1, 2])
+def test_reduce_chains_all(chain_count):
+    """The fused reduction gives the same result as reducing the pairings by AND and then by OR"""
+    rng = np.random.default_rng(42)
+    n = 200
+    has_chain = {c: rng.random(n) < 0.7 for c in [1, 2]}
+    d = {}
+    for c1, c2 in [(1, 1), (2, 2), (1, 2), (2, 1)]:
+        # targets without chain c2 are missing
+        d[(c1, c2)] = np.where(has_chain[c2], rng.integers(0, 4, n), NAN_DIST).astype(np.uint16)
+    target_chain_count = has_chain[1].astype(int) + has_chain[2].astype(int)
+    expected = reduce_or_into(
+        reduce_and(d[(1, 1)], d[(2, 2)], chain_count=chain_count),
+        reduce_and(d[(1, 2)], d[(2, 1)], chain_count=chain_count),
+    )
+    npt.assert_equal(
+        reduce_chains_all(
+            d[(1, 1)],
+            d[(2, 2)],
+            d[(1, 2)],
+            d[(2, 1)],
+            chain_count=chain_count,
+            target_chain_count=target_chain_count,
+        ),
+        expected,
+    )
 
 
 @pytest.mark.parametrize(
@@ -205,25 +255,37 @@ def test_dlnf_lookup_table(dlnf, feature_col, name, forward_expected, reverse_ex
     assert len(reverse.lookup) == len(reverse_expected)
     for (k, v), (k_expected, v_expected) in zip(reverse.lookup.items(), reverse_expected.items()):
         assert k == k_expected
-        assert list(v.todense().A1) == v_expected
+        tmp_array = np.zeros(len(v_expected), dtype=int)
+        tmp_array[v] = 1
+        assert list(tmp_array) == v_expected
+
+
+def test_reverse_lookup_table_csr():
+    """Numeric tables with integer keys store their index arrays in CSR format"""
+    rlt = ReverseLookupTable.from_dict_of_indices({3: [4, 1], 0: [2], 1: []}, "numeric", 5)
+    npt.assert_equal(rlt.indptr, [0, 1, 1, 1, 3])
+    npt.assert_equal(rlt.indices, [2, 4, 1])
+    npt.assert_equal(rlt[3], [4, 1])
+    npt.assert_equal(rlt[2], [])
+    assert rlt[3].base is rlt.indices
 
 
 @pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_square"], indirect=True)
 def test_dlnf_lookup(dlnf_with_lookup):
     assert (
-        list(dlnf_with_lookup.lookup(0, "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(4, "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(0, "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(4, "VJ_test").toarray())
         == [1, 0, 0, 0, 1, 0, 0, 0]
     )
-    assert list(dlnf_with_lookup.lookup(1, "VJ_test").todense().A1) == ([0, 2, 0, 0, 0, 0, 0, 1])
+    assert list(dlnf_with_lookup.lookup(1, "VJ_test").toarray()) == ([0, 2, 0, 0, 0, 0, 0, 1])
     assert (
-        list(dlnf_with_lookup.lookup(2, "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(5, "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(2, "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(5, "VJ_test").toarray())
         == [0, 0, 3, 4, 0, 3, 4, 0]
     )
     assert (
-        list(dlnf_with_lookup.lookup(3, "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(3, "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VJ_test").toarray())
         == [0, 0, 4, 3, 0, 4, 3, 0]
     )
 
@@ -231,49 +293,49 @@ def test_dlnf_lookup(dlnf_with_lookup):
 @pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_rectangle"], indirect=True)
 def test_dlnf_lookup_rect(dlnf_with_lookup):
     assert (
-        list(dlnf_with_lookup.lookup(0, "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(4, "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(0, "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(4, "VJ_test").toarray())
         == [1, 0, 0, 0, 1]
     )
-    assert list(dlnf_with_lookup.lookup(1, "VJ_test").todense().A1) == [0, 2, 2, 0, 0]
+    assert list(dlnf_with_lookup.lookup(1, "VJ_test").toarray()) == [0, 2, 2, 0, 0]
     assert (
-        list(dlnf_with_lookup.lookup(2, "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(5, "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(2, "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(5, "VJ_test").toarray())
         == [0, 0, 0, 0, 0]
     )
     assert (
-        list(dlnf_with_lookup.lookup(3, "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(3, "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VJ_test").toarray())
         == [0, 0, 0, 3, 0]
     )
 
 
 @pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_square"], indirect=True)
 def test_dlnf_lookup_nan(dlnf_with_lookup):
-    assert list(dlnf_with_lookup.lookup(0, "VDJ_test").todense().A1) == ([1, 0, 0, 0, 0, 0, 0, 0])
+    assert list(dlnf_with_lookup.lookup(0, "VDJ_test").toarray()) == ([1, 0, 0, 0, 0, 0, 0, 0])
     assert (
-        list(dlnf_with_lookup.lookup(3, "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(5, "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(3, "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(5, "VDJ_test").toarray())
         == [0, 0, 4, 3, 0, 3, 0, 0]
     )
     assert (
-        list(dlnf_with_lookup.lookup(4, "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(4, "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VDJ_test").toarray())
         == [0, 0, 0, 0, 0, 0, 0, 0]
     )
 
 
 @pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_rectangle"], indirect=True)
 def test_dlnf_lookup_nan_rect(dlnf_with_lookup):
-    assert list(dlnf_with_lookup.lookup(0, "VDJ_test").todense().A1) == ([1, 0, 0, 1, 0])
+    assert list(dlnf_with_lookup.lookup(0, "VDJ_test").toarray()) == ([1, 0, 0, 1, 0])
     assert (
-        list(dlnf_with_lookup.lookup(3, "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(5, "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(3, "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(5, "VDJ_test").toarray())
         == [0, 0, 0, 0, 0]
     )
     assert (
-        list(dlnf_with_lookup.lookup(4, "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(4, "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VDJ_test").toarray())
         == [0, 0, 0, 0, 0]
     )
 
@@ -282,35 +344,35 @@ def test_dlnf_lookup_nan_rect(dlnf_with_lookup):
 @pytest.mark.parametrize("clonotype_id", range(8))
 def test_dnlf_lookup_with_two_identical_forward_and_reverse_tables(dlnf_with_lookup, clonotype_id):
     npt.assert_array_equal(
-        list(dlnf_with_lookup.lookup(clonotype_id, "VJ_test").todense().A1),
-        list(dlnf_with_lookup.lookup(clonotype_id, "VJ_test", "VJ_test").todense().A1),
+        list(dlnf_with_lookup.lookup(clonotype_id, "VJ_test").toarray()),
+        list(dlnf_with_lookup.lookup(clonotype_id, "VJ_test", "VJ_test").toarray()),
     )
     npt.assert_array_equal(
-        list(dlnf_with_lookup.lookup(clonotype_id, "VDJ_test").todense().A1),
-        list(dlnf_with_lookup.lookup(clonotype_id, "VDJ_test", "VDJ_test").todense().A1),
+        list(dlnf_with_lookup.lookup(clonotype_id, "VDJ_test").toarray()),
+        list(dlnf_with_lookup.lookup(clonotype_id, "VDJ_test", "VDJ_test").toarray()),
     )
 
 
 @pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_square"], indirect=True)
 def test_dlnf_lookup_with_different_forward_and_reverse_tables(dlnf_with_lookup):
     # if entries don't exist the the other lookup table, should return empty iterator.
-    assert list(dlnf_with_lookup.lookup(7, "VDJ_test", "VJ_test").todense().A1) == ([0, 0, 0, 0, 0, 0, 0, 0])
+    assert list(dlnf_with_lookup.lookup(7, "VDJ_test", "VJ_test").toarray()) == ([0, 0, 0, 0, 0, 0, 0, 0])
 
-    assert list(dlnf_with_lookup.lookup(7, "VJ_test", "VDJ_test").todense().A1) == ([0, 1, 0, 0, 0, 0, 0, 0])
+    assert list(dlnf_with_lookup.lookup(7, "VJ_test", "VDJ_test").toarray()) == ([0, 1, 0, 0, 0, 0, 0, 0])
     assert (
-        list(dlnf_with_lookup.lookup(0, "VJ_test", "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(4, "VJ_test", "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(0, "VJ_test", "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(4, "VJ_test", "VDJ_test").toarray())
         == [1, 0, 0, 0, 0, 0, 0, 0]
     )
     assert (
-        list(dlnf_with_lookup.lookup(3, "VJ_test", "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VJ_test", "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(3, "VJ_test", "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VJ_test", "VDJ_test").toarray())
         == [0, 0, 4, 3, 0, 3, 0, 0]
     )
-    assert list(dlnf_with_lookup.lookup(2, "VDJ_test", "VJ_test").todense().A1) == ([0, 0, 3, 4, 0, 3, 4, 0])
+    assert list(dlnf_with_lookup.lookup(2, "VDJ_test", "VJ_test").toarray()) == ([0, 0, 3, 4, 0, 3, 4, 0])
     assert (
-        list(dlnf_with_lookup.lookup(4, "VDJ_test", "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VDJ_test", "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(4, "VDJ_test", "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VDJ_test", "VJ_test").toarray())
         == [0] * 8
     )
 
@@ -318,22 +380,56 @@ def test_dlnf_lookup_with_different_forward_and_reverse_tables(dlnf_with_lookup)
 @pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_rectangle"], indirect=True)
 def test_dlnf_lookup_with_different_forward_and_reverse_tables_rect(dlnf_with_lookup):
     # if entries don't exist the the other lookup table, should return empty iterator.
-    assert list(dlnf_with_lookup.lookup(7, "VDJ_test", "VJ_test").todense().A1) == ([0, 0, 0, 0, 0])
+    assert list(dlnf_with_lookup.lookup(7, "VDJ_test", "VJ_test").toarray()) == ([0, 0, 0, 0, 0])
 
-    assert list(dlnf_with_lookup.lookup(7, "VJ_test", "VDJ_test").todense().A1) == ([0, 1, 0, 0, 5])
+    assert list(dlnf_with_lookup.lookup(7, "VJ_test", "VDJ_test").toarray()) == ([0, 1, 0, 0, 5])
     assert (
-        list(dlnf_with_lookup.lookup(0, "VJ_test", "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(4, "VJ_test", "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(0, "VJ_test", "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(4, "VJ_test", "VDJ_test").toarray())
         == [1, 0, 0, 1, 0]
     )
     assert (
-        list(dlnf_with_lookup.lookup(3, "VJ_test", "VDJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VJ_test", "VDJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(3, "VJ_test", "VDJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VJ_test", "VDJ_test").toarray())
         == [0, 0, 0, 0, 0]
     )
-    assert list(dlnf_with_lookup.lookup(2, "VDJ_test", "VJ_test").todense().A1) == ([0, 0, 0, 0, 0])
+    assert list(dlnf_with_lookup.lookup(2, "VDJ_test", "VJ_test").toarray()) == ([0, 0, 0, 0, 0])
     assert (
-        list(dlnf_with_lookup.lookup(4, "VDJ_test", "VJ_test").todense().A1)
-        == list(dlnf_with_lookup.lookup(6, "VDJ_test", "VJ_test").todense().A1)
+        list(dlnf_with_lookup.lookup(4, "VDJ_test", "VJ_test").toarray())
+        == list(dlnf_with_lookup.lookup(6, "VDJ_test", "VJ_test").toarray())
         == [0, 0, 0, 0, 0]
     )
+
+
+@pytest.mark.parametrize("dlnf_with_lookup", ["dlnf_square", "dlnf_rectangle"], indirect=True)
+def test_dlnf_shared_memory(dlnf_with_lookup):
+    """Test that a pickled DoubleLookupNeighborFinder attaches to the distance matrices in shared memory"""
+    with dlnf_with_lookup.shared_memory():
+        dlnf2 = pickle.loads(pickle.dumps(dlnf_with_lookup))
+        for name, dist_mat in dlnf_with_lookup.distance_matrices.items():
+            npt.assert_array_equal(dlnf2.distance_matrices[name].toarray(), dist_mat.toarray())
+        for i in range(dlnf_with_lookup.n_rows):
+            npt.assert_array_equal(
+                dlnf2.lookup(i, "VJ_test", "VDJ_test").toarray(),
+                dlnf_with_lookup.lookup(i, "VJ_test", "VDJ_test").toarray(),
+            )
+        # the features are only required to add lookup tables, only the number of rows is sent along
+        assert dlnf2.feature_table.shape == (dlnf_with_lookup.n_rows, 0)
+        del dlnf2
+
+    # outside of the context, the distance matrices are pickled as usual
+    dlnf3 = pickle.loads(pickle.dumps(dlnf_with_lookup))
+    assert dlnf3.distance_matrices.keys() == dlnf_with_lookup.distance_matrices.keys()
+    assert dlnf3.feature_table.equals(dlnf_with_lookup.feature_table)
+
+
+@pytest.mark.parametrize("dist_type", ["numeric", "boolean"])
+def test_reverse_lookup_table_pickle(dist_type):
+    """The lookup of an unpickled table consists of views into its arrays again"""
+    rlt = ReverseLookupTable.from_dict_of_indices({3: [4, 1], 0: [2], 1: []}, dist_type, 5)
+    rlt2 = pickle.loads(pickle.dumps(rlt))
+    assert rlt2.lookup.keys() == rlt.lookup.keys()
+    for k, v in rlt.lookup.items():
+        npt.assert_equal(rlt2[k], v)
+    array_attr = "masks" if dist_type == "boolean" else "indices"
+    assert rlt2[3].base is getattr(rlt2, array_attr)